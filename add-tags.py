@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import argparse
 import boto3
+import botocore.client
 import botocore.exceptions
 
 LOG_FORMAT = '%(asctime)s %(filename)s:%(lineno)s[%(process)d]: %(levelname)s: %(message)s'
+BOTO_CFG = botocore.client.Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 6},
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+)
 
 
 class ArgsParser(argparse.ArgumentParser):
@@ -42,15 +51,32 @@ For example:
         return options
 
 
-def lookup(conn, host):
-    if host.startswith("i-") and (len(host) == 10 or len(host) == 19):
-        instances = conn.instances.filter(InstanceIds=[host])
-    else:
-        instances = conn.instances.filter(
-            Filters=[dict(Name='tag:Name', Values=[host])]
-        )
-    not list(instances) and logging.error('Cannot find %s' % host)
-    return [i.id for i in instances]
+def is_instance_id(host):
+    return host.startswith("i-") and (len(host) == 10 or len(host) == 19)
+
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def lookup(conn, hosts):
+    ids = [h for h in hosts if is_instance_id(h)]
+    names = [h for h in hosts if not is_instance_id(h)]
+    queries = [dict(InstanceIds=batch) for batch in chunks(ids, 200)]
+    queries.extend(dict(Filters=[dict(Name='tag:Name', Values=batch)]) for batch in chunks(names, 200))
+
+    found = []
+    if queries:
+        with ThreadPoolExecutor(max_workers=min(32, len(queries))) as executor:
+            for instances in executor.map(lambda q: list(conn.instances.filter(**q)), queries):
+                found.extend(instances)
+
+    found_keys = {i.id for i in found}
+    found_keys.update(t['Value'] for i in found for t in i.tags or [] if t['Key'] == 'Name')
+    for host in hosts:
+        host not in found_keys and logging.error('Cannot find %s' % host)
+    return list(dict.fromkeys(i.id for i in found))
 
 
 def main(args=None):
@@ -64,13 +90,8 @@ def main(args=None):
 
     try:
         session = boto3.session.Session(region_name=options.region, profile_name=options.profile)
-        ec2 = session.resource('ec2')
-        instances = []
-
-        for name in options.name:
-            instances.extend(
-                lookup(ec2, name)
-            )
+        ec2 = session.resource('ec2', config=BOTO_CFG)
+        instances = lookup(ec2, options.name)
 
         if instances:
             tags = []
@@ -79,11 +100,15 @@ def main(args=None):
                 tags.append(dict(Key=key, Value=value))
             options.verbose and logging.info('Setting tags on %s' % ' '.join(instances))
 
-            ec2.create_tags(
-                Resources=instances,
-                Tags=tags,
-                DryRun=options.dry_run,
-            )
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(
+                    lambda batch: ec2.create_tags(
+                        Resources=batch,
+                        Tags=tags,
+                        DryRun=options.dry_run,
+                    ),
+                    chunks(instances, 100),
+                ))
 
     except (botocore.exceptions.ClientError,
             botocore.exceptions.NoCredentialsError) as e:
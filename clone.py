@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import datetime
+import functools
 import logging
 import os
 import pathlib
@@ -10,6 +11,7 @@ import time
 from datetime import datetime, timedelta, timezone
 
 import boto3
+import botocore.client
 import botocore.exceptions
 
 USER_DATA = '''#!/bin/bash
@@ -18,6 +20,23 @@ set -euxo pipefail
 rm -rf /var/lib/docker/network/
 '''
 
+BOTO_CFG = botocore.client.Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 6},
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+)
+
+_SESSION_CACHE = {}
+
+
+def get_session(profile=None, region=None):
+    key = (profile, region)
+    if key not in _SESSION_CACHE:
+        _SESSION_CACHE[key] = boto3.session.Session(profile_name=profile, region_name=region)
+    return _SESSION_CACHE[key]
+
 
 class ArgsParser(argparse.ArgumentParser):
     def __init__(self, *args, **kwargs):
@@ -45,6 +64,8 @@ Example usage:
             '--security-group-ids', '--security_group_ids', dest='security_group_ids', help='Security group ids')
         self.add_argument('--subnet-id', '--subnet_id', dest='subnet_id', help='Subnet id')
         self.add_argument('--user-data', '--user_data', dest='user_data', help='Userdata script file')
+        self.add_argument('--rds-timeout', '--rds_timeout', dest='rds_timeout', type=int, default=24,
+                          help='Hours to wait for a restored RDS instance to become available')
         self.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help="Be verbose")
         self.add_argument('--dry_run', '--dry-run', dest='dry_run', action='store_true', default=False,
                           help="Don't actually do anything; just print out what would be done")
@@ -75,24 +96,29 @@ Example usage:
 class Clone(object):
     def __init__(self, options):
         self.options = options
-        self.session = boto3.session.Session(profile_name=options.profile, region_name=options.region)
-        self.ec2_res = self.session.resource('ec2')
-        self.ec2 = self.session.client('ec2')
-        self.rds = self.session.client('rds')
+        self.session = get_session(options.profile, options.region)
+        self.ec2_res = self.session.resource('ec2', config=BOTO_CFG)
+        self.ec2 = self.session.client('ec2', config=BOTO_CFG)
+        self.rds = self.session.client('rds', config=BOTO_CFG)
 
+    @functools.lru_cache(maxsize=256)
     def ec2_lookup(self, host):
         try:
             if host.startswith("i-") and (len(host) == 10 or len(host) == 19):
-                instances = self.ec2_res.instances.filter(InstanceIds=[host])
+                pages = [self.ec2.describe_instances(InstanceIds=[host])]
             else:
-                instances = self.ec2_res.instances.filter(
+                pages = self.ec2.get_paginator('describe_instances').paginate(
                     Filters=[
                         {'Name': 'tag:Name', 'Values': [host]},
                         {'Name': 'instance-state-name', 'Values': ['running']}
-                    ]
+                    ],
+                    PaginationConfig={'PageSize': 5},
                 )
-            return str([i.id for i in instances][0])
-        except (botocore.exceptions.ClientError, IndexError):
+            for page in pages:
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        return instance['InstanceId']
+        except botocore.exceptions.ClientError:
             return
 
     def rds_lookup(self, host):
@@ -104,31 +130,48 @@ class Clone(object):
 
     def find_latest_ec2_snapshot(self, name):
         try:
-            images = self.ec2.describe_images(Filters=[
-                {'Name': 'name', 'Values': ['%s_%s_*' % (name, self.session.region_name)]},
-                {'Name': 'state', 'Values': ['available']},
-            ])['Images']
-        except (botocore.exceptions.ClientError, IndexError):
+            pages = self.ec2.get_paginator('describe_images').paginate(
+                Filters=[
+                    {'Name': 'name', 'Values': ['%s_%s_*' % (name, self.session.region_name)]},
+                    {'Name': 'state', 'Values': ['available']},
+                ],
+                PaginationConfig={'PageSize': 100},
+            )
+            image = max(
+                (_ for page in pages for _ in page['Images']),
+                key=lambda x: x['CreationDate'],
+                default=None,
+            )
+        except botocore.exceptions.ClientError:
             logging.error('Cannot find image for %s' % name)
-            return
-        if images:
-            _sorted = sorted(images, key=lambda x: x['CreationDate'], reverse=False)
-            _latest_date = datetime.strptime(_sorted[-1]['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
+            return None, None
+        if image:
+            _latest_date = datetime.strptime(image['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
             logging.info(
                 'Latest "%s" snapshot (%s) is taken at %s' % (
                     name,
-                    _sorted[-1].get('ImageId'),
+                    image.get('ImageId'),
                     _latest_date,
                 )
             )
-            return _latest_date, _sorted[-1]
+            return _latest_date, image
         else:
             return None, None
 
     def find_latest_rds_snapshot(self, name):
-        images = self.rds.describe_db_snapshots(
-            DBInstanceIdentifier=name, IncludeShared=False, IncludePublic=False)
-        image = sorted(images.get('DBSnapshots'), key=lambda _: _['SnapshotCreateTime'])[-1]
+        pages = self.rds.get_paginator('describe_db_snapshots').paginate(
+            DBInstanceIdentifier=name,
+            IncludeShared=False,
+            IncludePublic=False,
+            PaginationConfig={'PageSize': 100},
+        )
+        image = max(
+            (_ for page in pages for _ in page['DBSnapshots']),
+            key=lambda _: _['SnapshotCreateTime'],
+            default=None,
+        )
+        if not image:
+            return None, None
         _latest_date = self.to_local_tz(image.get('SnapshotCreateTime'))
         logging.info(
             'Latest "%s" snapshot (%s) is taken at %s' % (
@@ -140,31 +183,37 @@ class Clone(object):
         return _latest_date, image
 
     def wait_until_ec2_available(self, start, instance):
-        instance = self.session.resource('ec2').Instance(instance['Instances'][0]['InstanceId'])
-        while instance.state['Name'] != 'running':
+        instance_id = instance['Instances'][0]['InstanceId']
+        instance = self.ec2_res.Instance(instance_id)
+        tags = self.tags_to_dict(instance.tags)
+
+        def progress(response):
+            states = [_['State']['Name'] for r in response.get('Reservations', []) for _ in r['Instances']]
             logging.info('%s is %s for %s' % (
-                self.get_tag(instance.tags, 'Name'),
-                instance.state['Name'],
+                tags.get('Name', 'Unknown'),
+                states[0] if states else 'pending',
                 self.chop_microseconds(datetime.now() - start)))
-            time.sleep(15)
-            instance.reload()
-        logging.info('%s is %s' % (
-            self.get_tag(instance.tags, 'Name'),
-            instance.state['Name']))
+
+        self.poll_waiter(
+            self.ec2.get_waiter('instance_running'), 15, 80, progress, InstanceIds=[instance_id])
+        instance.reload()
+        tags = self.tags_to_dict(instance.tags)
+        logging.info('%s is %s' % (tags.get('Name', 'Unknown'), instance.state['Name']))
         return instance
 
     def wait_until_rds_available(self, start, rds_name):
-        instance = self.rds.describe_db_instances(
-            DBInstanceIdentifier=rds_name)['DBInstances'][0]
-        while instance['DBInstanceStatus'] != 'available':
+        def progress(response):
+            states = [_['DBInstanceStatus'] for _ in response.get('DBInstances', [])]
             logging.info('%s is %s for %s' % (
                 rds_name,
-                instance['DBInstanceStatus'],
+                states[0] if states else 'pending',
                 self.chop_microseconds(datetime.now() - start)))
-            time.sleep(30)
-            instance = self.rds.describe_db_instances(
-                DBInstanceIdentifier=rds_name)['DBInstances'][0]
-        return instance
+
+        self.poll_waiter(
+            self.rds.get_waiter('db_instance_available'), 30, self.options.rds_timeout * 120, progress,
+            DBInstanceIdentifier=rds_name)
+        return self.rds.describe_db_instances(
+            DBInstanceIdentifier=rds_name)['DBInstances'][0]
 
     def clone(self, name):
         ec2_instance = self.ec2_lookup(name)
@@ -187,8 +236,8 @@ class Clone(object):
         if ec2_instance:
             try:
                 start = datetime.now()
-                original_name = self.get_tag(
-                    self.session.resource('ec2').Instance(ec2_instance).tags, 'Name')
+                ec2_instance = self.ec2_res.Instance(ec2_instance)
+                original_name = self.get_tag(ec2_instance.tags, 'Name')
 
                 new_name = self.options.new_name or '%s-clone%02d%02d%02d' % (
                     original_name,
@@ -197,7 +246,6 @@ class Clone(object):
                     int(start.minute)
                 )
 
-                ec2_instance = self.ec2_res.Instance(ec2_instance)
                 instance_type = self.options.instance_type or ec2_instance.instance_type
                 user_data = self.options.user_data or USER_DATA
                 assert user_data.startswith("#"), "Error: Bad user_data format"
@@ -303,24 +351,39 @@ class Clone(object):
             except botocore.exceptions.ClientError as _:
                 logging.error(_)
 
+    @staticmethod
+    def poll_waiter(waiter, delay, max_attempts, progress, **kwargs):
+        # one waiter attempt per tick, so progress can be logged between them
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return waiter.wait(WaiterConfig={'Delay': delay, 'MaxAttempts': 1}, **kwargs)
+            except botocore.exceptions.WaiterError as _:
+                if attempt == max_attempts or 'Max attempts exceeded' not in str(_):
+                    raise
+                progress(_.last_response or {})
+                time.sleep(delay)
+
     @staticmethod
     def chop_microseconds(delta):
         return delta - timedelta(microseconds=delta.microseconds)
 
     @staticmethod
     def get_tag(_tags, tag_name):
-        tag = [tag['Value'] for tag in _tags if tag['Key'] == tag_name]
-        return tag[0] if tag else 'Unknown'
+        return Clone.tags_to_dict(_tags).get(tag_name, 'Unknown')
+
+    @staticmethod
+    def tags_to_dict(_tags):
+        return {tag['Key']: tag['Value'] for tag in _tags or []}
 
     @staticmethod
     def to_local_tz(utc_dt):
         return utc_dt.replace(tzinfo=timezone.utc).astimezone(tz=None)
 
 
-def sigterm_handler(*args):
-    sig_name = next(v for v, k in signal.__dict__.items() if k == args[0])
-    logging.info('Exiting %s on %s' % (os.getpid(), sig_name))
-    exit(0)
+# noinspection PyUnusedLocal
+def sigterm_handler(signum, frame):
+    logging.info('Exiting %s on %s' % (os.getpid(), signal.Signals(signum).name))
+    sys.exit(0)
 
 
 def main(args=None):
@@ -344,6 +407,7 @@ def main(args=None):
             AssertionError,
             botocore.exceptions.ClientError,
             botocore.exceptions.NoCredentialsError,
+            botocore.exceptions.WaiterError,
     ) as _:
         raise SystemExit(_)
 
@@ -1,12 +1,11 @@
-import datetime
+import functools
 import logging
 import os
-import re
 import signal
-import subprocess
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 import argparse
@@ -18,6 +17,22 @@ import requests
 __version__ = '1.0.0'
 logger = logging.getLogger()
 
+BOTO_CFG = botocore.client.Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 6},
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+)
+METADATA_URL = 'http://169.254.169.254/latest'
+MAX_METRIC_DATA = 1000
+SKIP_FILESYSTEMS = {'tmpfs', 'devtmpfs', 'overlay', 'squashfs', 'proc', 'sysfs', 'cgroup', 'cgroup2'}
+
+_http = requests.Session()
+_executor = ThreadPoolExecutor(max_workers=4)
+_cloudwatch = None
+_cloudwatch_lock = threading.Lock()
+
 
 # noinspection PyTypeChecker
 class ArgsParser(argparse.ArgumentParser):
@@ -51,15 +66,9 @@ class ArgsParser(argparse.ArgumentParser):
         return options
 
 
-def pick(iterable, _g, *_args):
-    vs = list(_args)
-    for i, arg in enumerate(_args):
-        for item in iterable:
-            v = _g(item, arg)
-            if v:
-                vs[i] = v
-                break
-    return vs
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return max(f.read().count(b'\n') - 1, 0)
 
 
 def collect_metrics():
@@ -73,28 +82,27 @@ def collect_metrics():
     @collect
     def memory_utilization():
         with open('/proc/meminfo') as f:
-            def match(line, item):
-                meminfo_regex = re.compile(r'([A-Z][A-Za-z()_]+):\s+(\d+)(?: ([km]B))')
-                name, amount, unit = meminfo_regex.match(line).groups()
-                if name == item:
-                    assert unit == 'kB'
-                    return int(amount)
-            memtotal, memfree, buffers, _cached = pick(
-                f, match, 'MemTotal', 'MemFree', 'Buffers', 'Cached'
-            )
-            inactive = (memfree + buffers + _cached) / float(memtotal)
-            yield round(100 * (1 - inactive), 1), "Percent", ()
+            info = {}
+            for line in f:
+                name, amount = line.split()[:2]
+                info[name.rstrip(':')] = int(amount)
+        inactive = (info['MemFree'] + info['Buffers'] + info['Cached']) / float(info['MemTotal'])
+        yield round(100 * (1 - inactive), 1), "Percent", ()
 
     @collect
     def disk_space_utilization():
+        seen = set()
         with open('/proc/mounts') as f:
             for line in f:
                 if not line.startswith('/'):
                     continue
-                device, _path, filesystem, options = line.split(' ', 3)
+                device, _path, filesystem = line.split(None, 3)[:3]
+                if filesystem in SKIP_FILESYSTEMS:
+                    continue
                 result = os.statvfs(_path)
-                if not result.f_blocks:
+                if not result.f_blocks or result.f_fsid in seen:
                     continue
+                seen.add(result.f_fsid)
                 free = result.f_bfree / float(result.f_blocks)
                 yield round(100 * (1 - free), 1), "Percent", (
                     ("Filesystem", device),
@@ -110,82 +118,94 @@ def collect_metrics():
 
     @collect
     def network_connections():
-        i = 0
-        with open('/proc/net/tcp') as f:
-            for i, line in enumerate(f):
-                pass
-        yield i, "Count", (("Protocol", "TCP"), )
-        with open('/proc/net/udp') as f:
-            for i, line in enumerate(f):
-                pass
-        yield i, "Count", (("Protocol", "UDP"), )
+        yield count_lines('/proc/net/tcp'), "Count", (("Protocol", "TCP"), )
+        yield count_lines('/proc/net/udp'), "Count", (("Protocol", "UDP"), )
 
     @collect
     def open_file_descriptor_count():
-        p = subprocess.Popen(['lsof'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        t = threading.Timer(30, p.kill)
-        try:
-            t.start()
-            c = p.stdout.read().count('\n')
-            exit_code = p.wait()
-        finally:
-            t.cancel()
-        yield int(c) if exit_code == 0 else 0, "Count", ()
+        with open('/proc/sys/fs/file-nr') as f:
+            allocated = int(f.read().split()[0])
+        yield allocated, "Count", ()
 
     return data
 
 
-def metrics(_options):
-    session = boto3.session.Session(
-        profile_name=_options.profile or None, region_name=_options.region)
+@functools.lru_cache(maxsize=1)
+def instance_id():
+    headers = {}
+    try:
+        token = _http.put(
+            METADATA_URL + '/api/token',
+            headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'},
+            timeout=3,
+        )
+        token.raise_for_status()
+        headers['X-aws-ec2-metadata-token'] = token.text
+    except requests.exceptions.RequestException:
+        # no IMDSv2 token (e.g. hop limit 1 inside a container), fall back to IMDSv1 like botocore does
+        pass
+    response = _http.get(
+        METADATA_URL + '/meta-data/instance-id',
+        headers=headers,
+        timeout=3,
+    )
+    response.raise_for_status()
+    return response.text
+
+
+def cloudwatch_client(session):
+    global _cloudwatch
+    with _cloudwatch_lock:
+        if _cloudwatch is None:
+            _cloudwatch = session.client('cloudwatch', config=BOTO_CFG)
+        return _cloudwatch
+
+
+def metrics(_options, cloudwatch):
     data = collect_metrics()
     try:
-        dimensions = ('InstanceId',
-                      requests.get('http://169.254.169.254/latest/meta-data/instance-id', timeout=3).text
-                      ),
-    except requests.exceptions.ConnectionError:
+        dimension = ('InstanceId', instance_id())
+    except requests.exceptions.RequestException:
         raise SystemExit('Fatal Error: Not running on AWS EC2 instance')
-    for dimension in dimensions:
-        _options.verbose and logging.info('Collected metrics:\n' + pformat(data))
-        submit_metrics(session, _options.verbose, data, "System/Linux", dimension)
-        logger.info(
-            'Submitted %d metrics for dimension System/Linux: %s' % (len(data), dimension[0])
-        )
+    _options.verbose and logging.info('Collected metrics:\n' + pformat(data))
+    submit_metrics(cloudwatch, _options.verbose, data, "System/Linux", dimension)
+    logger.info(
+        'Submitted %d metrics for dimension System/Linux: %s' % (len(data), dimension[0])
+    )
 
 
-def submit_metrics(_session, verbose, data, namespace,  *dimensions):
-    config = botocore.client.Config(connect_timeout=5, retries={'max_attempts': 0})
+def submit_metrics(cloudwatch, verbose, data, namespace,  *dimensions):
+    base_dimensions = [{'Name': _name, 'Value': _value} for _name, _value in dimensions]
     metric_data = list()
     for name, (value, unit, metric_dimensions) in data:
-        metric_dimensions = tuple(metric_dimensions)
-        _dimensions = list()
-        for j, (_name, _value) in enumerate(dimensions + metric_dimensions):
-            _dimensions.append(
-                {
-                    'Name': _name,
-                    'Value': _value
-                }
-            )
         metric_data.append(
             {
                 'MetricName': name,
-                'Dimensions': _dimensions,
+                'Dimensions': base_dimensions + [
+                    {'Name': _name, 'Value': _value} for _name, _value in metric_dimensions
+                ],
                 'Value': value,
                 'Unit': unit,
             }
         )
     verbose and logging.info('Submitting metrics:\n' + pformat(metric_data))
-    try:
-        _session.client('cloudwatch', config=config).put_metric_data(
+    futures = [
+        _executor.submit(
+            cloudwatch.put_metric_data,
             Namespace=namespace,
-            MetricData=metric_data
-        )
-    except botocore.exceptions.ClientError as e:
-        logging.error(e)
+            MetricData=metric_data[i:i + MAX_METRIC_DATA]
+        ) for i in range(0, len(metric_data), MAX_METRIC_DATA)
+    ]
+    for future in futures:
+        try:
+            future.result()
+        except botocore.exceptions.ClientError as e:
+            logging.error(e)
 
 
-def sigterm_handler(*args):
-    sig_name = next(v for v, k in signal.__dict__.iteritems() if k == args[0])
+# noinspection PyUnusedLocal
+def sigterm_handler(signum, frame):
+    sig_name = signal.Signals(signum).name
     logging.info('Exiting %s on %s' % (os.getpid(), sig_name))
     sys.exit(0)
 
@@ -204,15 +224,21 @@ def main(args=sys.argv[1:]):
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=options.log_format)
     logging.info('Starting %s' % options.name)
 
-    while True:
-        next_run = datetime.datetime.now() + datetime.timedelta(seconds=options.interval)
+    session = boto3.session.Session(
+        profile_name=options.profile or None, region_name=options.region)
+    cloudwatch = cloudwatch_client(session)
 
-        metrics(options)
+    next_tick = time.monotonic()
+    while True:
+        metrics(options, cloudwatch)
 
-        dt = next_run.replace(second=0, microsecond=0) - datetime.datetime.now()
-        sleep_time = dt.seconds + dt.microseconds / 1e6 if dt.days >= 0 else options.interval
+        next_tick += options.interval
+        sleep_time = next_tick - time.monotonic()
+        if sleep_time < 0:
+            # fell behind by more than one interval, skip the missed ticks
+            next_tick, sleep_time = time.monotonic(), 0
 
-        options.verbose and logging.info('Sleeping for %s seconds' % sleep_time)
+        options.verbose and logging.info('Sleeping for %.2f seconds' % sleep_time)
         time.sleep(sleep_time)
 
 
@@ -3,12 +3,15 @@ import argparse
 import datetime
 import logging
 import os
+import re
 import signal
 import sys
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import boto3
+import botocore.client
 import botocore.exceptions
 
 
@@ -19,6 +22,19 @@ except ImportError:
     import queue
 
 q = queue.Queue()
+pending_images = {}
+pending_images_lock = threading.Lock()
+reconciler_error = None
+
+BOTO_CFG = botocore.client.Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+)
+MAX_WORKERS = 32
+TIMEOUT = datetime.timedelta(hours=4)
+INSTANCE_ID = re.compile(r'^i-[0-9a-f]{8}([0-9a-f]{9})?$')
+POLL_INTERVAL = 15
 
 
 # noinspection PyTypeChecker
@@ -56,8 +72,7 @@ For example:
         return options
 
 
-def create_ami(my_session, instance_id, ami_name, start, ami_desc=None):
-    conn = my_session.resource('ec2')
+def create_ami(conn, instance_id, ami_name, start, ami_desc=None):
     logging.info('Started creating image %s' % ami_name)
     try:
         request = conn.meta.client.create_image(
@@ -66,50 +81,85 @@ def create_ami(my_session, instance_id, ami_name, start, ami_desc=None):
             Name=ami_name,
             NoReboot=True
         )
-        image = conn.Image(request.get('ImageId'))
-
-        while image.state == 'pending':
-            logging.info('%s is %s for %s' % (
-                ami_name,
-                image.state,
-                chop_microseconds(datetime.datetime.now() - start))
-            )
-            time.sleep(15)
-            image.reload()
-
-        if image.state == 'available':
-            logging.info('Finished creating %s in %s' % (
-                ami_name,
-                chop_microseconds(datetime.datetime.now() - start))
-            )
-            return True, image.image_id
-        else:
-            return False, image.image_id
+        image_id = request.get('ImageId')
+        logging.info('Waiting for %s (%s) to become available' % (ami_name, image_id))
+        try:
+            state = watch_image(image_id).result()
+        except Exception as _:
+            # the reconciler died, the image may still complete but nobody is watching it
+            logging.error('Stopped waiting for %s (%s): %s' % (ami_name, image_id, _))
+            return False, image_id
+        if state != 'available':
+            logging.error('%s is %s' % (ami_name, state))
+            return False, image_id
+
+        logging.info('Finished creating %s in %s' % (
+            ami_name,
+            chop_microseconds(datetime.datetime.now() - start))
+        )
+        return True, image_id
 
     except (botocore.exceptions.ClientError,
-            botocore.exceptions.NoCredentialsError) as _:
+            botocore.exceptions.BotoCoreError) as _:
         logging.error(_)
         return False, None
 
 
-def clean_up(my_session, instance, region):
-    conn = my_session.resource('ec2')
+def watch_image(image_id):
+    future = Future()
+    with pending_images_lock:
+        if reconciler_error:
+            future.set_exception(reconciler_error)
+        else:
+            pending_images[image_id] = future
+    return future
+
+
+def reconcile_images(conn):
+    global reconciler_error
+    try:
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with pending_images_lock:
+                image_ids = list(pending_images)
+            if not image_ids:
+                continue
+            try:
+                # an image-id filter, unlike ImageIds, does not fail the whole call on one unknown id
+                images = conn.meta.client.describe_images(
+                    Filters=[{'Name': 'image-id', 'Values': image_ids}])['Images']
+            except (botocore.exceptions.ClientError,
+                    botocore.exceptions.BotoCoreError) as _:
+                logging.warning(_)
+                continue
+            for image in images:
+                if image['State'] == 'pending':
+                    continue
+                with pending_images_lock:
+                    future = pending_images.pop(image['ImageId'], None)
+                future and future.set_result(image['State'])
+    except Exception as _:
+        logging.error('Image reconciler stopped: %s' % _)
+        # fail the waiting workers now instead of leaving them blocked until TIMEOUT
+        with pending_images_lock:
+            reconciler_error = _
+            futures = list(pending_images.values())
+            pending_images.clear()
+        for future in futures:
+            future.set_exception(_)
+
+
+def clean_up(conn, instance_id, instance_name, region, images, used_amis):
     try:
-        instance_name = get_tag(instance.tags, 'Name')
-        images = list(conn.images.filter(Filters=[
-            {'Name': 'state', 'Values': ['available']},
-            {'Name': 'name', 'Values': ['%s_%s_*' % (instance_name, region)]}
-        ]))
         logging.info('Found %s images for %s (%s) in %s' % (
             len(images),
             instance_name,
-            instance.id,
+            instance_id,
             region
         ))
 
         current_week = datetime.datetime.utcnow().isocalendar()[1]
         purgeable = sorted(images, key=lambda x: x.creation_date, reverse=True)[7:]
-        used_amis = get_all_used_amis(my_session)
         not_purgeable = []
 
         for ami in purgeable:
@@ -121,32 +171,40 @@ def clean_up(my_session, instance, region):
             if len(not_purgeable) >= 7:
                 break
 
-        deleting = list(set(purgeable) - set(not_purgeable) - set(used_amis))
+        deleting = [ami for ami in set(purgeable) - set(not_purgeable) if ami.id not in used_amis]
         if deleting:
             logging.info('De-registering %s image%s for %s' % (
                 len(deleting),
                 's' if len(deleting) > 1 else '',
                 instance_name)
             )
-            for ami in deleting:
-                logging.info('De-registering %s (%s)' % (ami.name, ami.id))
-                conn.meta.client.deregister_image(ImageId=ami.id)
-                time.sleep(15)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda ami: deregister(conn, ami), deleting))
 
     except (botocore.exceptions.ClientError,
             botocore.exceptions.NoCredentialsError) as _:
         logging.error(_)
 
 
-def worker(profile, region):
-    session = boto3.session.Session(profile_name=profile, region_name=region)
-    while not q.empty():
-        instance_id = q.get()
+def deregister(conn, ami):
+    logging.info('De-registering %s (%s)' % (ami.name, ami.id))
+    try:
+        conn.meta.client.deregister_image(ImageId=ami.id)
+    except botocore.exceptions.ClientError as _:
+        logging.error(_)
+
+
+def worker(conn, images_by_name, used_amis):
+    region = conn.meta.client.meta.region_name
+    while True:
+        try:
+            instance_id, instance_name = q.get_nowait()
+        except queue.Empty:
+            return
         now = datetime.datetime.now()
-        instance = session.resource('ec2').Instance(instance_id)
         ami_name = '%s_%s_%s' % (
-            get_tag(instance.tags, 'Name'),
-            session.region_name,
+            instance_name,
+            region,
             '%s%02d%02d.%02d%02d' % (
                 now.year,
                 now.month,
@@ -155,9 +213,10 @@ def worker(profile, region):
                 now.minute,
             ),
         )
-        success, image_id = create_ami(session, instance.id, ami_name, now)
+        success, image_id = create_ami(conn, instance_id, ami_name, now)
         if success and image_id:
-            clean_up(session, instance, session.region_name)
+            images = images_by_name.get(instance_name, []) + [conn.Image(image_id)]
+            clean_up(conn, instance_id, instance_name, region, images, used_amis)
         q.task_done()
 
 
@@ -166,35 +225,55 @@ def chop_microseconds(delta):
 
 
 def get_tag(_tags, tag_name):
-    tag = [tag['Value'] for tag in _tags if tag['Key'] == tag_name]
-    return tag[0] if tag else 'Unknown'
-
-
-def lookup(conn, host, filters=None):
-    filters = filters or [{'Name': 'tag:Name', 'Values': [host]}]
-    if host.startswith("i-") and (len(host) == 10 or len(host) == 19):
-        instances = conn.instances.filter(InstanceIds=[host])
-    else:
-        instances = conn.instances.filter(
-            Filters=filters
-        )
-    not list(instances) and logging.error('Cannot find %s' % host)
-    return [i.id for i in instances]
-
-
-def get_all_used_amis(my_session):
-    conn = my_session.resource('ec2')
-    used_amis = [instance.image_id for instance in list(conn.instances.filter())]
-
-    auto_scaling = my_session.client('autoscaling')
-    launch_configs = auto_scaling.describe_launch_configurations()
-    used_amis.extend([lc.get('ImageId') for lc in launch_configs['LaunchConfigurations']])
-    return list(set(used_amis))
-
-
-def sigterm_handler(*args):
-    sig_name = next(v for v, k in signal.__dict__.items() if k == args[0])
-    logging.info('Exiting %s on %s' % (os.getpid(), sig_name))
+    return next((tag['Value'] for tag in _tags if tag['Key'] == tag_name), 'Unknown')
+
+
+def lookup(conn, hosts):
+    ids = [h for h in hosts if INSTANCE_ID.match(h)]
+    names = [h for h in hosts if not INSTANCE_ID.match(h)]
+    instances = []
+    if ids:
+        instances.extend(conn.instances.filter(InstanceIds=ids))
+    if names:
+        instances.extend(conn.instances.filter(Filters=[{'Name': 'tag:Name', 'Values': names}]))
+
+    found = {i.id for i in instances} | {get_tag(i.tags or [], 'Name') for i in instances}
+    for host in hosts:
+        host not in found and logging.error('Cannot find %s' % host)
+    return list({i.id: i for i in instances}.values())
+
+
+def get_images_by_name(conn, region):
+    images_by_name = {}
+    for image in conn.images.filter(Owners=['self'], Filters=[
+        {'Name': 'state', 'Values': ['available']},
+        {'Name': 'name', 'Values': ['*_%s_*' % region]}
+    ]):
+        images_by_name.setdefault(image.name.rsplit('_', 2)[0], []).append(image)
+    return images_by_name
+
+
+def get_all_used_amis(conn, autoscaling):
+    paginator = conn.meta.client.get_paginator('describe_instances')
+    used_amis = {
+        instance['ImageId']
+        for page in paginator.paginate()
+        for reservation in page['Reservations']
+        for instance in reservation['Instances']
+    }
+
+    paginator = autoscaling.get_paginator('describe_launch_configurations')
+    used_amis.update(
+        lc.get('ImageId')
+        for page in paginator.paginate()
+        for lc in page['LaunchConfigurations']
+    )
+    return used_amis
+
+
+# noinspection PyUnusedLocal
+def sigterm_handler(signum, frame):
+    logging.info('Exiting %s on %s' % (os.getpid(), signal.Signals(signum).name))
     sys.exit(0)
 
 
@@ -213,30 +292,40 @@ def main(args=None):
     try:
         logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=options.log_format)
         session = boto3.session.Session(profile_name=options.profile, region_name=options.region)
-        instances = []
         threads = []
-        start = datetime.datetime.now()
 
-        ec2 = session.resource('ec2', region_name=options.region)
+        ec2 = session.resource('ec2', config=BOTO_CFG)
+        autoscaling = session.client('autoscaling', config=BOTO_CFG)
         if options.instances:
-            for instance in options.instances:
-                instances.extend(lookup(ec2, instance))
+            instances = lookup(ec2, options.instances)
         else:
-            instances = lookup(ec2, '', filters=[{'Name': 'tag:Backup', 'Values': ['yes']}])
+            instances = list(ec2.instances.filter(Filters=[{'Name': 'tag:Backup', 'Values': ['yes']}]))
+            not instances and logging.error('Cannot find instances tagged Backup=yes')
+
+        images_by_name = get_images_by_name(ec2, options.region)
+        used_amis = get_all_used_amis(ec2, autoscaling)
 
+        # tags come with the DescribeInstances response, so workers never need to re-describe
         for _ in instances:
-            q.put(_)
+            q.put((_.id, get_tag(_.tags or [], 'Name')))
+
+        reconciler = threading.Thread(target=reconcile_images, args=[ec2])
+        reconciler.daemon = True
+        reconciler.start()
 
-        for _ in range(4):
-            worker_thread = threading.Thread(target=worker, args=[options.profile, options.region])
+        for _ in range(min(len(instances), MAX_WORKERS)):
+            worker_thread = threading.Thread(target=worker, args=[ec2, images_by_name, used_amis])
             worker_thread.daemon = True
             worker_thread.start()
             threads.append(worker_thread)
 
-        while len(threading.enumerate()) > 1:
-            if datetime.datetime.now() - start > datetime.timedelta(hours=4):
-                raise SystemExit('Exiting on timeout')
-            time.sleep(1)
+        deadline = time.monotonic() + TIMEOUT.total_seconds()
+        for worker_thread in threads:
+            worker_thread.join(max(0, deadline - time.monotonic()))
+        if any(_.is_alive() for _ in threads):
+            raise SystemExit('Exiting on timeout')
+        if reconciler_error:
+            raise SystemExit('Image reconciler failed: %s' % reconciler_error)
 
     except (botocore.exceptions.ClientError,
             botocore.exceptions.NoCredentialsError) as _:
@@ -1,55 +1,109 @@
 #!/usr/bin/env python3
 import argparse
-import boto3
-import botocore.exceptions
 import configparser
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
 import signal
 import sys
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 DEFAULT_EXPIRY_THRESHOLD_DAYS = 30 - 7
+IDENTITY_CACHE_TTL = 24 * 60 * 60
+MAX_ACCESS_KEYS = 2  # IAM quota per user
 DEFAULT_LOG_FORMAT = '[%(levelname)s] (%(filename)s:%(threadName)s:%(lineno)s) %(message)s'
+# boto3/botocore are imported on first use so that --help and usage errors stay fast
+AWS_CFG = dict(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=15,
+)
+CREDENTIAL_KEYS = {
+    # same delimiters and case folding as ConfigParser
+    _: re.compile(r'^(%s[ \t]*[=:][ \t]*).*$' % _, re.M | re.I) for _ in ['aws_access_key_id', 'aws_secret_access_key']
+}
+SECTION_HEADER = re.compile(r'^\[', re.M)
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(profile=None):
+    import boto3
+    return boto3.Session(profile_name=profile)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(service, profile=None):
+    import botocore.client
+    return get_session(profile).client(service, config=botocore.client.Config(**AWS_CFG))
 
 
 class AWSKey:
     def __init__(self, expiry_threshold_days=None, credentials_file='~/.aws/credentials',
-                 backup_file='~/.aws/credentials.old', options=None):
-        self.backed_up = False
+                 backup_file='~/.aws/credentials.old', identity_cache_file='~/.aws/.identity_cache.json',
+                 options=None):
+        self.dirty = False
+        self.identity_cache_dirty = False
+        self.lock = threading.Lock()
         self.options = options
         self.expiry_threshold_days = expiry_threshold_days or DEFAULT_EXPIRY_THRESHOLD_DAYS
-        self.session = boto3.Session()
+        self.cutoff = None
         self.credentials_file = Path(credentials_file).expanduser()
         self.backup_file = Path(backup_file).expanduser()
+        self.identity_cache_file = Path(identity_cache_file).expanduser()
+        self.identity_cache = self.load_identity_cache()
+        self.credentials = self.credentials_file.read_text() if self.credentials_file.exists() else ''
         self.config = configparser.ConfigParser()
-        self.config.read(self.credentials_file)
-        not self.credentials_file.exists() and logging.critical(f"{self.credentials_file} not found")
+        self.config.read_string(self.credentials)
+        if not self.credentials_file.exists():
+            logging.critical("%s not found", self.credentials_file)
 
     @staticmethod
-    def get_iam_username(session):
-        sts = session.client('sts')
-        identity = sts.get_caller_identity()
-        arn = identity['Arn']
-        if arn.endswith(':root'):
-            return None
-        username = arn.split('/')[-1]
+    def fingerprint(access_key_id):
+        return hashlib.sha256(access_key_id.encode()).hexdigest()[:16]
+
+    def load_identity_cache(self):
+        try:
+            cache = json.loads(self.identity_cache_file.read_text())
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        return {k: v for k, v in cache.items() if now - v[1] < IDENTITY_CACHE_TTL}
+
+    def save_identity_cache(self):
+        tmp_file = self.identity_cache_file.with_name(self.identity_cache_file.name + '.tmp')
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cachefile:
+            json.dump(self.identity_cache, cachefile)
+        os.replace(tmp_file, self.identity_cache_file)
+
+    def cache_iam_username(self, access_key_id, username):
+        with self.lock:
+            self.identity_cache[self.fingerprint(access_key_id)] = (username, time.time())
+            self.identity_cache_dirty = True
+
+    def get_iam_username(self, profile):
+        access_key_id = self.config[profile].get('aws_access_key_id')
+        if access_key_id and self.fingerprint(access_key_id) in self.identity_cache:
+            return self.identity_cache[self.fingerprint(access_key_id)][0]
+        arn = get_client('sts', profile).get_caller_identity()['Arn']
+        username = None if arn.endswith(':root') else arn.split('/')[-1]
+        access_key_id and self.cache_iam_username(access_key_id, username)
         return username
 
     @staticmethod
     def get_access_keys(iam, username):
-        if username:
-            response = iam.list_access_keys(UserName=username)
-        else:
-            response = iam.list_access_keys()
-        return response['AccessKeyMetadata']
-
-    def key_is_expiring_soon(self, access_key):
-        create_date = access_key['CreateDate']
-        days_elapsed = (datetime.now(create_date.tzinfo) - create_date).days
-        return days_elapsed >= self.expiry_threshold_days
+        kwargs = {'UserName': username} if username else {}
+        for page in iam.get_paginator('list_access_keys').paginate(**kwargs):
+            yield from page['AccessKeyMetadata']
 
     @staticmethod
     def create_new_access_key(iam, username):
@@ -71,46 +125,122 @@ class AWSKey:
         shutil.copy(self.credentials_file, self.backup_file)
 
     def update_credentials_file(self, profile, new_access_key):
-        if profile not in self.config:
-            self.config[profile] = {}
-
-        self.config[profile]['aws_access_key_id'] = new_access_key['AccessKeyId']
-        self.config[profile]['aws_secret_access_key'] = new_access_key['SecretAccessKey']
+        values = {
+            'aws_access_key_id': new_access_key['AccessKeyId'],
+            'aws_secret_access_key': new_access_key['SecretAccessKey'],
+        }
+        # ConfigParser takes everything up to the last ']' on the line as the section name
+        section_header = re.compile(r'^\[%s\][^\]\n]*$' % re.escape(profile), re.M)
+        with self.lock:
+            header = section_header.search(self.credentials)
+            if not header and profile in self.config:
+                raise configparser.Error("Cannot locate [%s] in %s" % (profile, self.credentials_file))
+            if not header:
+                self.credentials = self.credentials.rstrip('\n') + '\n\n[%s]\n' % profile
+                header = section_header.search(self.credentials)
+            end = SECTION_HEADER.search(self.credentials, header.end())
+            start, end = header.end(), end.start() if end else len(self.credentials)
+            section, missing = self.credentials[start:end], ''
+            for key, value in values.items():
+                section, found = CREDENTIAL_KEYS[key].subn(lambda m: m.group(1) + value, section, count=1)
+                if not found:
+                    missing += '\n%s = %s' % (key, value)
+            section = missing + section
+            self.credentials = self.credentials[:start] + section + self.credentials[end:]
+            self.dirty = True
 
-        with open(self.credentials_file, 'w') as configfile:
-            self.config.write(configfile)
+    def write_credentials_file(self):
+        tmp_file = self.credentials_file.with_name(self.credentials_file.name + '.tmp')
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as configfile:
+            configfile.write(self.credentials)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        if self.credentials_file.exists():
+            shutil.copymode(self.credentials_file, tmp_file)
+        os.replace(tmp_file, self.credentials_file)
 
     def replace_expiring_keys(self):
-        for profile in self.config.sections():
-            self.options.verbose and logging.info(f"Found profile: {profile}")
-            session = boto3.Session(profile_name=profile)
-            iam = session.client('iam')
-            username = self.get_iam_username(session)
-            access_keys = self.get_access_keys(iam, username)
+        profiles = self.config.sections()
+        if not profiles:
+            return
+        self.cutoff = datetime.now(timezone.utc) - timedelta(days=self.expiry_threshold_days)
+        expired, errors = [], []
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(profiles), 16)) as executor:
+                futures = {executor.submit(self.replace_profile_keys, _): _ for _ in profiles}
+            for future, profile in futures.items():
+                try:
+                    expired.extend(future.result())
+                except Exception as _:
+                    logging.error("Cannot rotate keys for profile %s: %s", profile, _)
+                    errors.append(_)
+        finally:
+            # whatever was created must reach the disk, even if another profile failed
+            if self.dirty:
+                self.backup_credentials_file()
+                logging.info("Backup of the credentials file created at %s", self.backup_file)
+                self.write_credentials_file()
+                logging.info("Updated %s with new access keys.", self.credentials_file)
+
+            if self.identity_cache_dirty:
+                self.save_identity_cache()
+
+        # only profiles whose replacement key is now on disk get their old keys deleted
+        if expired:
+            with ThreadPoolExecutor(max_workers=min(len(expired), 4)) as executor:
+                for access_key_id in executor.map(lambda _: self.delete_access_key(*_) or _[2], expired):
+                    logging.info("Deleted old access key: %s", access_key_id)
+
+        if errors:
+            raise errors[0]
+
+    def replace_profile_keys(self, profile):
+        if self.options.verbose:
+            logging.info("Found profile: %s", profile)
+        iam = get_client('iam', profile)
+        username = self.get_iam_username(profile)
+        # materialized so that keys created below cannot shift the pages being read
+        access_keys = list(self.get_access_keys(iam, username))
+        expiring = []
 
-            for access_key in access_keys:
-                self.options.verbose and logging.info(f"Found access_key: {access_key['AccessKeyId']}")
-                if self.key_is_expiring_soon(access_key):
-                    if not self.backed_up:
-                        self.backup_credentials_file()
-                        logging.info(f"Backup of the credentials file created at {self.backup_file}")
-                        self.backed_up = True
-                    logging.info(f"Access key {access_key['AccessKeyId']} is expiring soon.")
+        # oldest first, so the scan can stop at the first key that is not expiring
+        for access_key in sorted(access_keys, key=lambda _: _['CreateDate']):
+            if self.options.verbose:
+                logging.info("Found access_key: %s", access_key['AccessKeyId'])
+            if access_key['CreateDate'] > self.cutoff:
+                break
+            logging.info("Access key %s is expiring soon.", access_key['AccessKeyId'])
+            expiring.append(access_key)
 
-                    new_access_key = self.create_new_access_key(iam, username)
-                    logging.info(f"Created new access key: {new_access_key['AccessKeyId']}")
+        if not expiring:
+            return []
+        if len(access_keys) >= MAX_ACCESS_KEYS:
+            # make room for the replacement with an expiring key no profile in the file is using
+            in_use = {self.config[_].get('aws_access_key_id') for _ in self.config.sections()}
+            spare = next((_ for _ in expiring if _['AccessKeyId'] not in in_use), None)
+            if spare:
+                self.delete_access_key(iam, username, spare['AccessKeyId'])
+                logging.info("Deleted old access key: %s", spare['AccessKeyId'])
+                expiring.remove(spare)
 
-                    self.update_credentials_file(profile, new_access_key)
-                    logging.info("Updated ~/.aws/credentials with new access key.")
+        new_access_key = self.create_new_access_key(iam, username)
+        logging.info("Created new access key: %s", new_access_key['AccessKeyId'])
+        self.cache_iam_username(new_access_key['AccessKeyId'], username)
 
-                    self.delete_access_key(iam, username, access_key['AccessKeyId'])
-                    logging.info(f"Deleted old access key: {access_key['AccessKeyId']}")
+        try:
+            self.update_credentials_file(profile, new_access_key)
+        except Exception:
+            # the secret would be lost, so do not leave the new key behind
+            self.delete_access_key(iam, username, new_access_key['AccessKeyId'])
+            raise
+        return [(iam, username, access_key['AccessKeyId']) for access_key in expiring]
 
 
 # noinspection PyTypeChecker,PyUnusedLocal
 def sigterm_handler(signum, frame):
     signal_name = signal.Signals(signum).name
-    logging.info(f'Exiting {os.getpid()} on {signal_name}')
+    logging.info('Exiting %s on %s', os.getpid(), signal_name)
     sys.exit(0)
 
 
@@ -118,9 +248,11 @@ if __name__ == "__main__":
     my_parser = argparse.ArgumentParser(description="Rotate AWS keys")
     my_parser.add_argument('-v', '--verbose', action='store_true', help='Be verbose')
     options = my_parser.parse_args()
+    import botocore.exceptions
 
     for _ in ['boto3', 'botocore']:
-        not options.verbose and logging.getLogger(_).setLevel(logging.CRITICAL)
+        if not options.verbose:
+            logging.getLogger(_).setLevel(logging.CRITICAL)
 
     for _ in [signal.SIGINT, signal.SIGTERM]:
         # noinspection PyTypeChecker
@@ -3,10 +3,15 @@ import logging
 import sys
 
 import argparse
-import boto3
-import botocore.exceptions
 
 LOG_FORMAT = '%(asctime)s %(filename)s:%(lineno)s[%(process)d]: %(levelname)s: %(message)s'
+# boto3/botocore are imported after argument parsing so that --help and usage errors stay fast
+AWS_CFG = dict(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=15,
+)
 
 
 class ArgsParser(argparse.ArgumentParser):
@@ -40,47 +45,52 @@ For example
         return options
 
 
-def lookup(conn, host):
-    if host.startswith("i-") and (len(host) == 10 or len(host) == 19):
-        instances = conn.instances.filter(InstanceIds=[host])
-    else:
-        instances = conn.instances.filter(
-            Filters=[dict(Name='tag:Name', Values=[host])]
-        )
-    not list(instances) and logging.error('Cannot find %s' % host)
-    return [i.id for i in instances]
+def is_instance_id(host):
+    return host.startswith("i-") and (len(host) == 10 or len(host) == 19)
+
+
+def lookup(client, hosts):
+    ids = [h for h in hosts if is_instance_id(h)]
+    names = [h for h in hosts if not is_instance_id(h)]
+    paginator = client.get_paginator('describe_instances')
+    pages = []
+    if ids:
+        pages.extend(paginator.paginate(InstanceIds=ids))
+    if names:
+        pages.extend(paginator.paginate(Filters=[dict(Name='tag:Name', Values=names)]))
+    instances = [i for page in pages for r in page['Reservations'] for i in r['Instances']]
+
+    found = {i['InstanceId'] for i in instances}
+    found.update(t['Value'] for i in instances for t in i.get('Tags', []) if t['Key'] == 'Name')
+    for host in hosts:
+        if host not in found:
+            logging.error('Cannot find %s', host)
+    return list(dict.fromkeys(i['InstanceId'] for i in instances))
 
 
 def main(args=None):
     args = args or sys.argv[1:]
     my_parser = ArgsParser()
     options = my_parser.parse_args(args)
+    import boto3
+    import botocore.client
+    import botocore.exceptions
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=LOG_FORMAT)
 
     for m in ['boto3', 'botocore']:
-        not options.verbose and logging.getLogger(m).setLevel(logging.CRITICAL)
+        if not options.verbose:
+            logging.getLogger(m).setLevel(logging.CRITICAL)
 
     try:
         session = boto3.session.Session(region_name=options.region, profile_name=options.profile)
-        ec2 = session.resource('ec2')
-        instances = []
-
-        for name in options.name:
-            instances.extend(
-                lookup(ec2, name)
-            )
+        ec2 = session.client('ec2', config=botocore.client.Config(**AWS_CFG))
+        instances = lookup(ec2, options.name)
 
         if instances:
-            if options.command == 'start':
-                session.client('ec2').start_instances(
-                    InstanceIds=instances,
-                    DryRun=options.dry_run
-                )
-            elif options.command == 'stop':
-                session.client('ec2').stop_instances(
-                    InstanceIds=instances,
-                    DryRun=options.dry_run
-                )
+            getattr(ec2, '%s_instances' % options.command)(
+                InstanceIds=instances,
+                DryRun=options.dry_run
+            )
 
     except (botocore.exceptions.ClientError,
             botocore.exceptions.NoCredentialsError) as e:
@@ -2,25 +2,13 @@
 import argparse
 import errno
 import logging
+import random
 import socket
 import sys
 import time
-import warnings
 
-import cryptography.utils
-import paramiko
-
-# To fix issues with libcrypto.dylib loading after updating to MacOS X Catalina
-# Run:
-# brew update & brew upgrade & brew install openssl
-# cd /usr/local/Cellar/openssl/1.0.2t/
-# sudo cp libssl.1.0.0.dylib libcrypto.1.0.0.dylib /usr/local/lib/
-# cd /usr/local/lib/
-# sudo ln -s libssl.1.0.0.dylib libssl.dylib
-# sudo ln -s libcrypto.1.0.0.dylib libcrypto.dylib
-
-# silence EllipticCurvePublicNumbers deprecation warnings
-warnings.simplefilter("ignore", cryptography.utils.CryptographyDeprecationWarning)
+BACKOFF_CAP = 10.0
+PROBE_TIMEOUT = 1
 
 
 # noinspection PyTypeChecker
@@ -40,6 +28,7 @@ For example:
         self.add_argument('port', help='SSH port', nargs="?", default="22")
         self.add_argument('-t', '--timeout', help='timeout in seconds', nargs="?", default="180")
         self.add_argument('-r', '--retry_interval', '--retry-interval', help='retry interval', nargs="?", default="1")
+        self.add_argument('--full-handshake', action='store_true', help='complete the SSH key exchange (needs paramiko)')
 
     def error(self, message):
         sys.stderr.write(f'Error: {message}\n\n')
@@ -53,34 +42,52 @@ For example:
         return options
 
 
-def wait_for_ssh_to_be_ready(host, port, timeout, retry_interval):
-    client = paramiko.client.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def handshake(sock):
+    import paramiko
+    transport = paramiko.Transport(sock)
+    try:
+        transport.start_client(timeout=PROBE_TIMEOUT)
+        # start_client returns quietly on timeout, this raises until the key exchange has finished
+        transport.get_remote_server_key()
+        return True
+    except (paramiko.SSHException, EOFError):
+        return False
+    finally:
+        transport.close()
+
+
+def probe(host, port, full_handshake=False):
+    with socket.create_connection((host, int(port)), timeout=PROBE_TIMEOUT) as sock:
+        # peek, so that the banner is still there for paramiko to read
+        if not sock.recv(4, socket.MSG_PEEK | socket.MSG_WAITALL).startswith(b'SSH-'):
+            return False
+        return handshake(sock) if full_handshake else True
+
+
+def backoff(attempt, base, cap):
+    # clamped, so a long run cannot overflow the float conversion
+    return min(cap, base * 2 ** min(attempt, 16)) * (0.5 + random.random() * 0.5)
+
+
+def wait_for_ssh_to_be_ready(host, port, timeout, retry_interval, full_handshake=False):
     timeout_start = time.time()
-    while time.time() < timeout_start + int(timeout):
-        try:
-            time.sleep(float(retry_interval))
-            client.connect(
-                host,
-                int(port),
-                allow_agent=False,
-                look_for_keys=False,
-                timeout=1
-            )
-        except paramiko.ssh_exception.SSHException as _:
-            logging.info('SSH transport is available!')
-            break
-        except paramiko.ssh_exception.NoValidConnectionsError as _:
-            logging.info('SSH transport is not ready')
-            continue
-        except socket.error as _:
-            logging.info(str(_).capitalize())
-            continue
-        except KeyboardInterrupt:
-            sys.exit(errno.EINTR)
-    else:
-        logging.critical("Timeout exceeded")
-        sys.exit(errno.ETIME)
+    base = float(retry_interval)
+    attempt = 0
+    try:
+        while time.time() < timeout_start + int(timeout):
+            try:
+                if probe(host, port, full_handshake):
+                    logging.info('SSH transport is available!')
+                    return
+                logging.info('SSH transport is not ready')
+            except socket.error as _:
+                logging.info(str(_).capitalize())
+            time.sleep(backoff(attempt, base, max(BACKOFF_CAP, base)))
+            attempt += 1
+    except KeyboardInterrupt:
+        sys.exit(errno.EINTR)
+    logging.critical("Timeout exceeded")
+    sys.exit(errno.ETIME)
 
 
 def main(args=None):
@@ -96,7 +103,8 @@ def main(args=None):
         options.host,
         options.port,
         options.timeout,
-        options.retry_interval
+        options.retry_interval,
+        options.full_handshake
     )
 
 
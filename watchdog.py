@@ -4,12 +4,11 @@
     but not more frequently than cooldown timeout. Persistent information is stored in /tmp
 """
 import argparse
-import contextlib
 import datetime
+import json
 import logging.handlers
 import os
 import random
-import shelve
 import shlex
 import socket
 import subprocess
@@ -19,6 +18,7 @@ import time
 
 
 logger = logging.getLogger()
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 
 # noinspection PyTypeChecker
@@ -37,9 +37,13 @@ For example:
         self.options = None
         self.add_argument('-a', '--address', dest='service_address', default='192.168.1.230')
         self.add_argument('-p', '--port', dest='service_port', type=int, default=22)
-        self.add_argument('-r', '--retry_after', type=int, dest='seconds', default=61)
+        self.add_argument('-r', '--retry_after', type=int, dest='seconds', default=61,
+                          help='seconds between connect attempts (at least this, growing up to twice this)')
         self.add_argument('-c', '--command', dest='command', default='echo restarting')
         self.add_argument('-cd', '--cooldown', type=int, dest='hours', default=4)
+        self.add_argument('-d', '--daemon', action='store_true', default=False,
+                          help='keep running and check every --interval seconds')
+        self.add_argument('-i', '--interval', type=int, dest='interval', default=60)
 
     def error(self, message):
         sys.stderr.write('error: %s\n' % message)
@@ -51,33 +55,114 @@ For example:
         options.log_format = '%(filename)s:%(lineno)s[%(process)d]: %(levelname)s %(message)s'
         options.command_cooldown = datetime.timedelta(hours=options.hours)
         options.name = os.path.splitext(__file__)[0]
+        options.state_file = os.path.join(tempfile.gettempdir(), '%s.json' % os.path.basename(options.name))
         self.options = options
         return options
 
 
+def backoff(attempt, base, cap):
+    # clamped, so a long run cannot overflow the float conversion
+    return min(cap, base * 2 ** min(attempt, 16)) * (0.5 + random.random() * 0.5)
+
+
+def is_reachable(address, port):
+    try:
+        with socket.create_connection((address, port), timeout=5) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            return True
+    except (socket.error, socket.timeout):
+        return False
+
+
 def execute(command):
     try:
         exec_errors = subprocess.call(shlex.split(command))
         if not exec_errors:
-            logging.info('Watchdog executed "%s"' % shlex.split(command))
+            logging.info('Watchdog executed "%s"', shlex.split(command))
             return datetime.datetime.now()
     except OSError as e:
-        logging.error('Exec error: %s' % e)
+        logging.error('Exec error: %s', e)
         raise SystemExit(1)
 
 
+def format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if timestamp else None
+
+
+def parse_timestamp(value):
+    try:
+        # [:19] also reads files written with isoformat(), which may carry microseconds
+        return datetime.datetime.strptime(value[:19], TIMESTAMP_FORMAT) if value else None
+    except ValueError:
+        return None
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def update_state(state, options, new_state):
+    if new_state != state:
+        state.clear()
+        state.update(new_state)
+        save_state(options.state_file, state)
+
+
 def start_logging(_log_format):
     _logger = logging.getLogger()
     try:
-        handler = logging.handlers.SysLogHandler(address='/dev/log')
+        handler = logging.handlers.SysLogHandler(address='/dev/log', socktype=socket.SOCK_DGRAM)
+        # newer Pythons swallow the connect error, so check that the socket is really connected
+        handler.socket.getpeername()
+        handler.ident = 'watchdog: '
     except socket.error:
-        handler = logging.StreamHandler(sys.stdout)
+        # stay quiet under cron rather than mailing stdout
+        handler = logging.NullHandler()
     handler.setFormatter(logging.Formatter(_log_format))
     _logger.setLevel(logging.INFO)
     _logger.addHandler(handler)
     return _logger
 
 
+def check_once(state, options):
+    logging.info('Starting watchdog run')
+    executed = parse_timestamp(state.get('executed'))
+    reachable = False
+    for attempt in range(0, random.randint(3, 5)):
+        reachable = is_reachable(options.service_address, options.service_port)
+        if reachable:
+            break
+        logging.info('Trying to connect to %s:%s',
+                     options.service_address, options.service_port)
+        time.sleep(max(options.seconds, backoff(attempt, options.seconds, 2 * options.seconds)))
+    else:
+        logging.info('Cannot connect to %s:%s, issuing exec',
+                     options.service_address, options.service_port)
+    if not reachable and not executed:
+        update_state(state, options, {'executed': format_timestamp(execute(options.command))})
+    elif not reachable and executed:
+        if datetime.datetime.now() - executed >= options.command_cooldown:
+            update_state(state, options, {'executed': format_timestamp(execute(options.command))})
+        else:
+            next_run = (executed + options.command_cooldown).strftime('%Y-%m-%d %H:%M:%S')
+            logging.info('Watchdog exec cooldown is in effect until %s', next_run)
+    else:
+        logging.info('%s:%s OK', options.service_address, options.service_port)
+        update_state(state, options, {})
+
+
 def main(args=None):
     args = args or sys.argv[1:]
     my_parser = ArgsParser()
@@ -86,35 +171,11 @@ def main(args=None):
     logger = start_logging(options.log_format)
 
     try:
-        logging.info('Starting watchdog run')
-        with contextlib.closing(shelve.open(os.path.join(tempfile.gettempdir(), options.name), 'c')) as shelf, \
-                contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            sock.settimeout(5)
-            connect_errors = None
-            executed = shelf.get(options.name)
-            for _ in range(0, random.randint(3, 5)):
-                connect_errors = sock.connect_ex(
-                    (options.service_address, options.service_port))
-                if not connect_errors:
-                    break
-                else:
-                    logging.info('Trying to connect to %s:%s' % (
-                        options.service_address, options.service_port))
-                    time.sleep(options.seconds)
-            else:
-                logging.info('Cannot connect to %s:%s, issuing exec' %
-                             (options.service_address, options.service_port))
-            if connect_errors and not executed:
-                shelf[options.name] = execute(options.command)
-            elif connect_errors and executed:
-                if datetime.datetime.now() - executed >= options.command_cooldown:
-                    shelf[options.name] = execute(options.command)
-                else:
-                    next_run = (executed + options.command_cooldown).strftime('%Y-%m-%d %H:%M:%S')
-                    logging.info('Watchdog exec cooldown is in effect until %s' % next_run)
-            else:
-                logging.info('%s:%s OK' % (options.service_address, options.service_port))
-                shelf.clear()
+        state = load_state(options.state_file)
+        check_once(state, options)
+        while options.daemon:
+            time.sleep(options.interval)
+            check_once(state, options)
     except KeyboardInterrupt:
         sys.exit(0)
 